@@ -1,16 +1,120 @@
 import os
 import re
 import json
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+import asyncio
+import shutil
+import tempfile
+import dataclasses
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json
+    orjson = None
+
+# Precompiled patterns used in the per-cell loops
+_SSN_RE = re.compile(r"\d{3}-\d{2}-\d{4}")
+_LINE_ITEM_RE = re.compile(r"^(\d+)\.\s*(.+)$")
+_NUMERIC_CHAR_RE = re.compile(r"[\d$,()\-.]")
+
+# Concurrent Azure Layout requests (retries are left to azure-core's RetryPolicy)
+MAX_AZURE_WORKERS = 10
+AZURE_POLLING_INTERVAL = 1  # seconds between status polls when the service sends no Retry-After
+
+
+@dataclass(slots=True)
+class Field:
+    """One cell of a table row (serialized as a JSON object by orjson)"""
+    columnIndex: int
+    columnId: str
+    columnName: str
+    value: str
+    cleanedValue: str
+
+
+def dumps_json(obj, depth=0):
+    """Serialize obj as 2-space indented UTF-8 JSON, re-indented to sit at the given nesting depth"""
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(obj, indent=2, ensure_ascii=False, default=dataclasses.asdict).encode("utf-8")
+    if depth:
+        data = data.replace(b"\n", b"\n" + b"  " * depth)
+    return data
+
+
+# =============================================
+#  Streaming Report Writer
+# =============================================
+class HybridReportWriter:
+    """
+    Writes {"documentInfo": ..., "tables": [...]} without holding every table in memory.
+    Tables are serialized to a spool file as they are produced, one segment per source
+    (split PDF), so sources can arrive in any order; finish() assembles the output file
+    with the segments in the requested order once documentInfo is known.
+    Use as a context manager so the spool file is released even on errors.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.table_count = 0
+        self.segments = {}  # key -> (offset, length) in the spool
+        self.spool = tempfile.TemporaryFile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.spool.close()
+
+    def add_segment(self, key, tables):
+        """Spool an iterable of tables as one contiguous segment"""
+        start = self.spool.seek(0, os.SEEK_END)
+        count = 0
+        for table_data in tables:
+            if count:
+                self.spool.write(b",\n")
+            self.spool.write(b"    " + dumps_json(table_data, depth=2))
+            count += 1
+        if count:
+            self.segments[key] = (start, self.spool.tell() - start)
+            self.table_count += count
+
+    def finish(self, document_info, order):
+        with open(self.output_path, "wb") as f:
+            f.write(b'{\n  "documentInfo": ' + dumps_json(document_info, depth=1) + b',\n  "tables": [')
+            first = True
+            for key in order:
+                if key not in self.segments:
+                    continue
+                f.write(b"\n" if first else b",\n")
+                first = False
+                start, remaining = self.segments[key]
+                self.spool.seek(start)
+                while remaining:
+                    chunk = self.spool.read(min(remaining, 1 << 20))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if not first:
+                f.write(b"\n  ")
+            f.write(b"]\n}")
+
 
 # =============================================
 #  OCR JSON Builder (Replicates C# Logic)
 # =============================================
 class OcrJsonBuilder:
     def __init__(self):
+        # Azure SDK is imported here so helpers can be used without paying its import cost
+        from azure.core.credentials import AzureKeyCredential
+        from azure.ai.documentintelligence import DocumentIntelligenceClient
+        from azure.core.pipeline.transport import RequestsTransport
+        import requests
+        from requests.adapters import HTTPAdapter
+
         load_dotenv()
 
         endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
@@ -19,156 +123,265 @@ class OcrJsonBuilder:
         if not endpoint or not key:
             raise ValueError("❌ Azure credentials not found in .env file")
 
+        self.endpoint = endpoint
+        self.credential = AzureKeyCredential(key)
+
+        # One pooled HTTPS session shared by every sync Azure call (avoids a TLS handshake
+        # per request); one connection per worker thread. The transport owns the session,
+        # so close() releases it.
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_AZURE_WORKERS, pool_maxsize=MAX_AZURE_WORKERS)
+        session.mount("https://", adapter)
+        transport = RequestsTransport(session=session, session_owner=True)
+
         self.client = DocumentIntelligenceClient(
-            endpoint=endpoint, credential=AzureKeyCredential(key)
+            endpoint=endpoint, credential=self.credential, transport=transport
         )
 
+    def close(self):
+        """Close the sync client and its pooled HTTP session"""
+        self.client.close()
+
     # -----------------------------------------
     # 1. Entry point for split PDFs
     # -----------------------------------------
-    def process_split_pdfs(self, split_pdfs):
+    def process_split_pdfs(self, split_pdfs, output_path="tax_comparison_hybrid.json"):
+        """
+        Analyze the split PDFs and write the hybrid JSON report to output_path.
+
+        Each Azure result is turned into tables and spooled to disk as soon as it
+        arrives, then released, so neither the results nor the tables accumulate in
+        memory. The returned dict therefore does not contain the tables:
+        {"documentInfo": {...}, "tablesWritten": int, "outputPath": str}.
+        Read the tables back from outputPath if they are needed.
+        """
         print("\n=== PROCESSING SPLIT PDFs WITH AZURE LAYOUT MODEL ===\n")
 
         report = {
             "documentInfo": {"pageCount": 0, "tableCount": 0, "metadata": {}},
-            "tables": []
+            "tablesWritten": 0,
+            "outputPath": output_path,
         }
+        document_info = report["documentInfo"]
+        order = [self.custom_id(p) for p in split_pdfs]
+        pdf_metadata = {}
 
-        for pdf_info in split_pdfs:
-            pdf_path = pdf_info["file_path"]
-            form_type = pdf_info.get("form_type", "Unknown")
+        with HybridReportWriter(output_path) as writer:
+            def on_result(pdf_info, result):
+                print(f"📄 Processing: {os.path.basename(pdf_info['file_path'])}")
+                print(f"   Form Type: {pdf_info.get('form_type', 'Unknown')}")
 
-            print(f"📄 Processing: {os.path.basename(pdf_path)}")
-            print(f"   Form Type: {form_type}")
+                if not result:
+                    print(f"   ⚠️ Skipping (no result)\n")
+                    return
 
-            result = self.run_azure_layout(pdf_path)
-            if not result:
-                print(f"   ⚠️ Skipping (no result)\n")
-                continue
+                # Update document info
+                document_info["pageCount"] += len(result.pages or [])
+                document_info["tableCount"] += len(result.tables or [])
 
-            # Update document info
-            report["documentInfo"]["pageCount"] += len(result.pages or [])
-            report["documentInfo"]["tableCount"] += len(result.tables or [])
+                key = self.custom_id(pdf_info)
+                pdf_metadata[key] = {}
+                writer.add_segment(key, self.iter_tables(result, pdf_metadata[key]))
 
-            # Extract metadata (taxpayer name, id)
-            self.extract_metadata(result, report["documentInfo"]["metadata"])
+            self.analyze_split_pdfs(split_pdfs, on_result)
 
-            # Build structured tables
-            tables = self.generate_hybrid_structure(result, form_type)
-            report["tables"].extend(tables)
+            # Results arrive in completion order; merge metadata in split order so
+            # the first PDF that has a value wins
+            for key in order:
+                for name, value in pdf_metadata.get(key, {}).items():
+                    document_info["metadata"].setdefault(name, value)
 
-        print("\n=== SAVING HYBRID JSON ===\n")
-        with open("tax_comparison_hybrid.json", "w", encoding="utf-8") as f:
-            json.dump(report, f, indent=2, ensure_ascii=False)
+            print("\n=== SAVING HYBRID JSON ===\n")
+            writer.finish(document_info, order)
+            report["tablesWritten"] = writer.table_count
 
-        print("✅ Saved: tax_comparison_hybrid.json")
-        print(f"  - Tables: {len(report['tables'])}")
-        print(f"  - Total Pages: {report['documentInfo']['pageCount']}")
-        print(f"  - Taxpayer: {report['documentInfo']['metadata'].get('taxpayerName', 'Unknown')}\n")
+        print(f"✅ Saved: {output_path}")
+        print(f"  - Tables: {report['tablesWritten']}")
+        print(f"  - Total Pages: {document_info['pageCount']}")
+        print(f"  - Taxpayer: {document_info['metadata'].get('taxpayerName', 'Unknown')}\n")
 
         return report
 
+    def iter_tables(self, result, metadata):
+        """
+        Yield the structured tables of one Azure result. Each table's grid is built
+        once and feeds both the metadata extraction (taxpayer name, id) and the table.
+        """
+        for t_index, table in enumerate(result.tables or []):
+            try:
+                grid = self.build_grid(table)
+                self.extract_metadata_from_grid(grid, metadata)
+                table_data = self.build_table_data(grid, table)
+            except Exception as ex:
+                print(f"   ⚠️ Error processing table {t_index}: {ex}")
+                continue
+            print(f"   ✓ Table {t_index + 1}: {table.row_count} rows, {table.column_count} cols")
+            yield table_data
+
     # -----------------------------------------
     # 2. Run Azure Document Intelligence
     # -----------------------------------------
-    def run_azure_layout(self, pdf_path):
+    def custom_id(self, pdf_info):
+        """Key used to re-associate an Azure result with its split PDF"""
+        pages = pdf_info.get("pages") or []
+        page_range = f"{pages[0]}-{pages[-1]}" if pages else os.path.basename(pdf_info["file_path"])
+        return f"{pdf_info.get('form_type', 'Unknown')}:{page_range}"
+
+    def analyze_split_pdfs(self, split_pdfs, on_result):
+        """
+        Analyze all split PDFs, calling on_result(pdf_info, result) on this thread
+        as each one completes (result is None on failure).
+        Uses the async client when available, otherwise the sync client
+        on a thread pool.
+        """
+        try:
+            import aiohttp  # noqa: F401 - transport required by the async client
+            from azure.ai.documentintelligence.aio import (
+                DocumentIntelligenceClient as AsyncDocumentIntelligenceClient,
+            )
+        except ImportError:
+            print("   ℹ️ Async client unavailable, using sync client\n")
+            self.analyze_with_threads(split_pdfs, on_result)
+            return
+
+        asyncio.run(self.analyze_async(split_pdfs, on_result, AsyncDocumentIntelligenceClient))
+
+    async def analyze_async(self, split_pdfs, on_result, client_cls):
+        semaphore = asyncio.Semaphore(MAX_AZURE_WORKERS)
+
+        async with client_cls(endpoint=self.endpoint, credential=self.credential) as aclient:
+            async def bounded(pdf_info):
+                async with semaphore:
+                    return pdf_info, await self.run_azure_layout_async(aclient, pdf_info["file_path"])
+
+            for next_done in asyncio.as_completed([bounded(p) for p in split_pdfs]):
+                on_result(*await next_done)
+
+    def analyze_with_threads(self, split_pdfs, on_result):
+        with ThreadPoolExecutor(max_workers=MAX_AZURE_WORKERS) as executor:
+            futures = {executor.submit(self.run_azure_layout, p["file_path"]): p for p in split_pdfs}
+            for future in as_completed(futures):
+                on_result(futures.pop(future), future.result())
+
+    def read_pdf(self, pdf_path):
         try:
             with open(pdf_path, "rb") as f:
-                pdf_bytes = f.read()
+                return f.read()
+        except OSError as e:
+            print(f"   ❌ Error ({os.path.basename(pdf_path)}): {e}")
+            return None
 
-            print("   🔍 Sending to Azure (prebuilt-layout)...")
-            poller = self.client.begin_analyze_document("prebuilt-layout", pdf_bytes)
+    # Transient failures (connection errors, 429, 5xx) are retried by azure-core's
+    # RetryPolicy on both the submit and the polling requests, so no retry loop here
+    async def run_azure_layout_async(self, aclient, pdf_path):
+        name = os.path.basename(pdf_path)
+        pdf_bytes = self.read_pdf(pdf_path)
+        if pdf_bytes is None:
+            return None
+
+        try:
+            print(f"   🔍 Sending to Azure (prebuilt-layout): {name}...")
+            poller = await aclient.begin_analyze_document(
+                "prebuilt-layout", pdf_bytes, polling_interval=AZURE_POLLING_INTERVAL
+            )
+            result = await poller.result()
+            print(f"   ✓ Layout extraction complete ({name}): {len(result.pages)} pages, {len(result.tables)} tables")
+            return result
+        except Exception as e:
+            print(f"   ❌ Error ({name}): {e}")
+            return None
+
+    def run_azure_layout(self, pdf_path):
+        name = os.path.basename(pdf_path)
+        pdf_bytes = self.read_pdf(pdf_path)
+        if pdf_bytes is None:
+            return None
+
+        try:
+            print(f"   🔍 Sending to Azure (prebuilt-layout): {name}...")
+            poller = self.client.begin_analyze_document(
+                "prebuilt-layout", pdf_bytes, polling_interval=AZURE_POLLING_INTERVAL
+            )
             result = poller.result()
-            print(f"   ✓ Layout extraction complete: {len(result.pages)} pages, {len(result.tables)} tables")
+            print(f"   ✓ Layout extraction complete ({name}): {len(result.pages)} pages, {len(result.tables)} tables")
             return result
         except Exception as e:
-            print(f"   ❌ Error: {e}")
+            print(f"   ❌ Error ({name}): {e}")
             return None
 
     # -----------------------------------------
     # 3. Extract metadata (name, SSN)
     # -----------------------------------------
-    def extract_metadata(self, result, metadata):
-        for table in result.tables or []:
-            grid = [["" for _ in range(table.column_count)] for _ in range(table.row_count)]
-            for cell in table.cells:
-                grid[cell.row_index][cell.column_index] = (cell.content or "").strip()
-
-            for r in range(min(3, table.row_count)):
-                for c in range(table.column_count):
-                    cell = grid[r][c]
-                    if not cell:
-                        continue
-
-                    # Taxpayer name (contains &)
-                    if "&" in cell and len(cell) > 10 and "taxpayerName" not in metadata:
-                        metadata["taxpayerName"] = cell
-
-                    # Taxpayer ID (XXX-XX-XXXX)
-                    ssn = re.search(r"\d{3}-\d{2}-\d{4}", cell)
-                    if ssn and "taxpayerId" not in metadata:
-                        metadata["taxpayerId"] = ssn.group(0)
+    def extract_metadata_from_grid(self, grid, metadata):
+        # Taxpayer identity usually comes from the first table; stop once both are known
+        if "taxpayerName" in metadata and "taxpayerId" in metadata:
+            return
+
+        for r in range(min(3, grid.shape[0])):
+            for cell in grid[r]:
+                if not cell:
+                    continue
+
+                # Taxpayer name (contains &)
+                if "&" in cell and len(cell) > 10 and "taxpayerName" not in metadata:
+                    metadata["taxpayerName"] = cell
+
+                # Taxpayer ID (XXX-XX-XXXX)
+                ssn = _SSN_RE.search(cell)
+                if ssn and "taxpayerId" not in metadata:
+                    metadata["taxpayerId"] = ssn.group(0)
+
+                if "taxpayerName" in metadata and "taxpayerId" in metadata:
+                    return
 
     # -----------------------------------------
     # 4. Generate hybrid JSON tables
     # -----------------------------------------
-    def generate_hybrid_structure(self, result, form_type):
-        tables_out = []
-        for t_index, table in enumerate(result.tables or []):
-            try:
-                grid = [["" for _ in range(table.column_count)] for _ in range(table.row_count)]
-                for cell in table.cells:
-                    grid[cell.row_index][cell.column_index] = (cell.content or "").strip()
-
-                table_data = {
-                    "formType": self.detect_form_type(grid),
-                    "rowCount": table.row_count,
-                    "columnCount": table.column_count,
-                    "columns": [],
-                    "data": []
-                }
-
-                # Define columns (header row)
-                for c in range(table.column_count):
-                    col_name = grid[0][c] or f"Column_{c}"
-                    table_data["columns"].append({
-                        "columnIndex": c,
-                        "columnId": f"col_{c}",
-                        "columnName": col_name,
-                        "dataType": self.infer_data_type(grid, c)
-                    })
-
-                # Add rows (skip header)
-                for r in range(1, table.row_count):
-                    fields = []
-                    for c, col in enumerate(table_data["columns"]):
-                        val = grid[r][c]
-                        fields.append({
-                            "columnIndex": c,
-                            "columnId": col["columnId"],
-                            "columnName": col["columnName"],
-                            "value": val,
-                            "cleanedValue": self.clean_value(val, col["dataType"])
-                        })
-
-                    line_item = self.try_extract_line_item(fields)
-                    row_data = {
-                        "rowIndex": r,
-                        "rowId": f"row_{r}",
-                        "fields": fields,
-                    }
-                    if line_item:
-                        row_data["lineItem"] = line_item
-
-                    table_data["data"].append(row_data)
-
-                tables_out.append(table_data)
-                print(f"   ✓ Table {t_index + 1}: {table.row_count} rows, {table.column_count} cols")
-
-            except Exception as ex:
-                print(f"   ⚠️ Error processing table {t_index}: {ex}")
+    def build_table_data(self, grid, table):
+        table_data = {
+            "formType": self.detect_form_type(grid),
+            "rowCount": table.row_count,
+            "columnCount": table.column_count,
+            "columns": [],
+            "data": []
+        }
 
-        return tables_out
+        # Define columns (header row)
+        for c in range(table.column_count):
+            col_name = grid[0][c] or f"Column_{c}"
+            table_data["columns"].append({
+                "columnIndex": c,
+                "columnId": f"col_{c}",
+                "columnName": col_name,
+                "dataType": self.infer_data_type(grid, c)
+            })
+
+        # Column schema as plain tuples for the per-cell loop
+        columns = table_data["columns"]
+        ids = tuple(col["columnId"] for col in columns)
+        names = tuple(col["columnName"] for col in columns)
+        types = tuple(col["dataType"] for col in columns)
+
+        # Add rows (skip header)
+        for r in range(1, table.row_count):
+            fields = []
+            row = grid[r]
+            for c in range(len(columns)):
+                val = row[c]
+                fields.append(Field(c, ids[c], names[c], val, self.clean_value(val, types[c])))
+
+            line_item = self.try_extract_line_item(fields)
+            row_data = {
+                "rowIndex": r,
+                "rowId": f"row_{r}",
+                "fields": fields,
+            }
+            if line_item:
+                row_data["lineItem"] = line_item
+
+            table_data["data"].append(row_data)
+
+        return table_data
 
     # -----------------------------------------
     # 5. Detect Form Type (Fixed placement)
@@ -190,6 +403,19 @@ class OcrJsonBuilder:
     # -----------------------------------------
     # 6. Helpers
     # -----------------------------------------
+    def build_grid(self, table):
+        """Lay table cells out in a (rows x cols) object array of stripped strings"""
+        cells = table.cells or []
+        rows_idx = np.fromiter((c.row_index for c in cells), dtype=np.int32, count=len(cells))
+        cols_idx = np.fromiter((c.column_index for c in cells), dtype=np.int32, count=len(cells))
+        contents = np.empty(len(cells), dtype=object)
+        contents[:] = [(c.content or "").strip() for c in cells]
+
+        grid = np.empty((table.row_count, table.column_count), dtype=object)
+        grid.fill("")
+        grid[rows_idx, cols_idx] = contents
+        return grid
+
     def infer_data_type(self, grid, col):
         numeric_count = 0
         text_count = 0
@@ -199,7 +425,7 @@ class OcrJsonBuilder:
             cell = r[col]
             if not cell:
                 continue
-            if re.search(r"[\d$,\(\)\-\.]", cell):
+            if _NUMERIC_CHAR_RE.search(cell):
                 numeric_count += 1
             else:
                 text_count += 1
@@ -217,8 +443,11 @@ class OcrJsonBuilder:
 
     def try_extract_line_item(self, fields):
         for f in fields:
-            val = f["value"]
-            match = re.match(r"^(\d+)\.\s*(.+)$", val)
+            val = f.value
+            # Cheap prefilter: most fields cannot start with "<digits>."
+            if not val or not val[0].isdigit() or "." not in val:
+                continue
+            match = _LINE_ITEM_RE.match(val)
             if match:
                 return {
                     "lineNumber": match.group(1),
@@ -252,7 +481,10 @@ def main():
     print("STEP 2: RUNNING AZURE OCR (LAYOUT MODEL)")
     print("=" * 60)
     builder = OcrJsonBuilder()
-    builder.process_split_pdfs(split_pdfs)
+    try:
+        builder.process_split_pdfs(split_pdfs)
+    finally:
+        builder.close()
 
 
 if __name__ == "__main__":
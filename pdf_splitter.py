@@ -1,8 +1,95 @@
-import PyPDF2
 import os
-from pdf2image import convert_from_path
-import pytesseract
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import ahocorasick
+except ImportError:  # fall back to per-keyword substring checks
+    ahocorasick = None
+
+# Only form-header keywords are needed, so treat each page as one text block
+TESSERACT_CONFIG = "--psm 6 -c tessedit_do_invert=0"
+
+# Form-type detection only needs header text: rasterize coarsely and OCR the top of the page
+OCR_DPI = 100
+HEADER_FRACTION = 4  # OCR the top 1/4 of each page
+
+# Every keyword consulted by identify_form_type
+FORM_KEYWORDS = (
+    "form 1040", "1040", "comparison",
+    "north carolina", "d-400", "d 400",
+    "ohio", "it-1040", "it 1040", "it1040", "nonresident",
+    "california", "540",
+    "new york", "it-201", "it 201",
+    "texas", "florida", "pennsylvania", "new jersey", "illinois", "massachusetts",
+    "state", "income tax", "return",
+)
+
+# Keywords that can move a page off a Federal run
+STATE_KEYWORDS = frozenset((
+    "north carolina", "d-400", "d 400",
+    "ohio", "it-1040", "it 1040", "it1040",
+    "california", "540",
+    "new york", "it-201", "it 201",
+    "texas", "florida", "pennsylvania", "new jersey", "illinois", "massachusetts",
+    "state",
+))
+
+# Labels a page header can settle on its own, without full-page OCR
+HEADER_FINAL_FORMS = frozenset((
+    "Federal",
+    "State - North Carolina (D-400)",
+    "State - Ohio (IT-1040)",
+    "State - California (540)",
+    "State - New York (IT-201)",
+))
+
+
+def build_keyword_automaton(keywords):
+    """Compile all keywords into one Aho-Corasick automaton (None if unavailable)"""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+
+FORM_AUTOMATON = build_keyword_automaton(FORM_KEYWORDS)
+STATE_AUTOMATON = build_keyword_automaton(STATE_KEYWORDS)
+
+
+def find_keywords(text_lower):
+    """Return the set of FORM_KEYWORDS present in text_lower, in a single pass when possible"""
+    if FORM_AUTOMATON is not None:
+        return {keyword for _, keyword in FORM_AUTOMATON.iter(text_lower)}
+    return {keyword for keyword in FORM_KEYWORDS if keyword in text_lower}
+
+
+def has_state_keyword(text_lower):
+    """True if text_lower contains any STATE_KEYWORDS; stops at the first match"""
+    if STATE_AUTOMATON is not None:
+        for _ in STATE_AUTOMATON.iter(text_lower):
+            return True
+        return False
+    return any(keyword in text_lower for keyword in STATE_KEYWORDS)
+
+
+def ocr_header(image):
+    """OCR the header band of a page image (module-level so it can run in worker processes)"""
+    import pytesseract
+    
+    header = image.crop((0, 0, image.width, image.height // HEADER_FRACTION))
+    return pytesseract.image_to_string(header, config=TESSERACT_CONFIG)
+
+
+def ocr_page(image):
+    """OCR a full page image (module-level so it can run in worker processes)"""
+    import pytesseract
+    
+    return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+
 
 class TaxPdfSplitter:
     def __init__(self, pdf_path):
@@ -42,6 +129,8 @@ class TaxPdfSplitter:
     
     def detect_form_types_with_ocr(self):
         """Detect form types using OCR on scanned PDFs"""
+        from pdf2image import convert_from_path
+        
         page_form_types = []
         
         print("🔍 Running OCR on scanned PDF pages...\n")
@@ -49,14 +138,26 @@ class TaxPdfSplitter:
         try:
             # Convert PDF pages to images
             print("Converting PDF to images...")
-            images = convert_from_path(self.pdf_path, dpi=150)
+            images = convert_from_path(self.pdf_path, dpi=OCR_DPI, thread_count=os.cpu_count() or 1)
             print(f"✓ Converted {len(images)} pages to images\n")
             
-            for page_num, image in enumerate(images):
-                print(f"Processing page {page_num + 1}...")
+            # Run OCR on all pages in parallel: header band first, then the full page
+            # for any page whose header does not identify a specific form
+            with ProcessPoolExecutor() as executor:
+                texts = list(executor.map(ocr_header, images))
                 
-                # Run OCR on the image
-                text = pytesseract.image_to_string(image)
+                fallback = [i for i, text in enumerate(texts) if self.needs_full_page_ocr(text, i)]
+                if fallback:
+                    print(f"Running full-page OCR on {len(fallback)} page(s)...\n")
+                    full_texts = executor.map(ocr_page, [images[i] for i in fallback])
+                    for page_index, text in zip(fallback, full_texts):
+                        texts[page_index] = text
+            
+            # Form of the current run of pages; Unknown pages inside a Federal run
+            # keep it Federal, exactly as group_pages_intelligently will group them
+            run_form = None
+            for page_num, text in enumerate(texts):
+                print(f"Processing page {page_num + 1}...")
                 
                 print(f"  OCR extracted {len(text)} characters")
                 
@@ -67,11 +168,14 @@ class TaxPdfSplitter:
                 else:
                     print("  ⚠️ No text extracted!")
                 
-                # Detect form type from FULL text (not just header)
+                # Detect form type from the header text, or from the full page when the
+                # header alone did not give Federal or a qualified state form
                 text_lower = text.lower()
                 
                 # Detect form type
-                form_type = self.identify_form_type(text_lower, page_num)
+                form_type = self.identify_form_type(text_lower, page_num, run_form)
+                if not self.should_group_with_previous(run_form, form_type):
+                    run_form = form_type
                 
                 print(f"  → Detected: {form_type}\n")
                 
@@ -90,72 +194,91 @@ class TaxPdfSplitter:
         
         return page_form_types
     
-    def identify_form_type(self, text_lower, page_num):
+    def needs_full_page_ocr(self, header_text, page_num):
+        """
+        Header text is only trusted when no text further down the page could change the
+        label: Federal, or a state form number that outranks every other qualifier.
+        Bare state labels (a form number may appear lower down), Ohio (Nonresident)
+        (IT-1040 outranks it) and Unknown labels are re-read from the full page.
+        """
+        form_type = self.identify_form_type(header_text.lower(), page_num)
+        return form_type not in HEADER_FINAL_FORMS
+    
+    def identify_form_type(self, text_lower, page_num, run_form=None):
         """
         Identify form type from OCR text
         Priority order:
         1. Federal Form 1040
         2. Specific state forms (by state name or form number)
         3. Generic state (if contains "state" keywords)
+        
+        Pages inside a Federal run (run_form) stay Federal unless they mention a state keyword.
         """
         
+        # Federal continuation: a state-only scan (stopping at the first hit) replaces
+        # the full keyword scan and cascade on contiguous Federal pages
+        if run_form == "Federal" and not has_state_keyword(text_lower):
+            return "Federal"
+        
+        found = find_keywords(text_lower)
+        
         # Federal detection
-        if "form 1040" in text_lower or ("1040" in text_lower and "comparison" in text_lower):
+        if "form 1040" in found or ("1040" in found and "comparison" in found):
             return "Federal"
         
         # State-specific detection
         # North Carolina
-        if "north carolina" in text_lower:
-            if "d-400" in text_lower or "d 400" in text_lower:
+        if "north carolina" in found:
+            if "d-400" in found or "d 400" in found:
                 return "State - North Carolina (D-400)"
             return "State - North Carolina"
         
         # Ohio
-        if "ohio" in text_lower:
-            if "it-1040" in text_lower or "it 1040" in text_lower or "it1040" in text_lower:
+        if "ohio" in found:
+            if "it-1040" in found or "it 1040" in found or "it1040" in found:
                 return "State - Ohio (IT-1040)"
-            if "nonresident" in text_lower:
+            if "nonresident" in found:
                 return "State - Ohio (Nonresident)"
             return "State - Ohio"
         
         # California
-        if "california" in text_lower:
-            if "540" in text_lower:
+        if "california" in found:
+            if "540" in found:
                 return "State - California (540)"
             return "State - California"
         
         # New York
-        if "new york" in text_lower:
-            if "it-201" in text_lower or "it 201" in text_lower:
+        if "new york" in found:
+            if "it-201" in found or "it 201" in found:
                 return "State - New York (IT-201)"
             return "State - New York"
         
         # Texas
-        if "texas" in text_lower:
+        if "texas" in found:
             return "State - Texas"
         
         # Florida
-        if "florida" in text_lower:
+        if "florida" in found:
             return "State - Florida"
         
         # Pennsylvania
-        if "pennsylvania" in text_lower:
+        if "pennsylvania" in found:
             return "State - Pennsylvania"
         
         # New Jersey
-        if "new jersey" in text_lower:
+        if "new jersey" in found:
             return "State - New Jersey"
         
         # Illinois
-        if "illinois" in text_lower:
+        if "illinois" in found:
             return "State - Illinois"
         
         # Massachusetts
-        if "massachusetts" in text_lower:
+        if "massachusetts" in found:
             return "State - Massachusetts"
         
         # Generic state detection (if no specific state found)
-        if "state" in text_lower and ("income tax" in text_lower or "return" in text_lower or "comparison" in text_lower):
+        if "state" in found and ("income tax" in found or "return" in found or "comparison" in found):
             return f"State - Unknown (Page {page_num + 1})"
         
         return "Unknown"
@@ -226,34 +349,48 @@ class TaxPdfSplitter:
     
     def create_split_pdfs(self, form_groups):
         """Create separate PDF files for each form group"""
+        try:
+            import pikepdf  # qpdf backend: copies page objects natively
+        except ImportError:
+            pikepdf = None
+        
         split_pdfs = []
         
-        # Create output directory
-        if os.path.exists(self.output_dir):
-            import shutil
-            shutil.rmtree(self.output_dir)
-        os.makedirs(self.output_dir)
+        # Create output directory (reused between runs; outputs are overwritten in place)
+        os.makedirs(self.output_dir, exist_ok=True)
+        
+        # Remove split PDFs left over from a previous run ("<counter>_<form>.pdf")
+        with os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                counter, sep, _ = entry.name.partition("_")
+                if entry.is_file() and sep and counter.isdigit() and entry.name.endswith(".pdf"):
+                    os.remove(entry.path)
         
         try:
-            with open(self.pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
+            # Open the source PDF once for all groups
+            if pikepdf is not None:
+                pdf_source = pikepdf.open(self.pdf_path)
+            else:
+                import PyPDF2
+                pdf_source = PyPDF2.PdfReader(self.pdf_path)
+            
+            try:
                 for counter, group in enumerate(form_groups, start=1):
                     # Create filename
                     form_name = group['form_type'].replace(" ", "_").replace("(", "").replace(")", "").replace("-", "")
                     output_filename = f"{counter}_{form_name}.pdf"
                     output_path = os.path.join(self.output_dir, output_filename)
                     
-                    # Create new PDF writer
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    # Add pages to new PDF
-                    for page_index in group['page_indices']:
-                        pdf_writer.add_page(pdf_reader.pages[page_index])
-                    
-                    # Write to file
-                    with open(output_path, 'wb') as output_file:
-                        pdf_writer.write(output_file)
+                    # Copy the group's pages into a new PDF and write it
+                    if pikepdf is not None:
+                        pdf_writer = pikepdf.Pdf.new()
+                        pdf_writer.pages.extend(pdf_source.pages[i] for i in group['page_indices'])
+                        pdf_writer.save(output_path)
+                    else:
+                        pdf_writer = PyPDF2.PdfWriter()
+                        pdf_writer.append(pdf_source, pages=list(group['page_indices']), import_outline=False)
+                        with open(output_path, 'wb') as output_file:
+                            pdf_writer.write(output_file)
                     
                     split_pdfs.append({
                         'file_path': output_path,
@@ -264,6 +401,9 @@ class TaxPdfSplitter:
                     print(f"✓ Created: {output_filename}")
                     print(f"    Form: {group['form_type']}")
                     print(f"    Pages: {', '.join(map(str, group['pages']))}")
+            finally:
+                if pikepdf is not None:
+                    pdf_source.close()
                     
         except Exception as e:
             print(f"❌ Error creating split PDFs: {e}")